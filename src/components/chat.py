@@ -1,11 +1,15 @@
 import streamlit as st
-import json
+import orjson
+import pandas as pd
 import csv
 import io
 from datetime import datetime
 from src.services.pinecone_service import PineconeService
 from src.services.langchain_service import LangChainService
+from langchain.schema import HumanMessage, AIMessage
 from src.config.settings import (
+    MAX_MESSAGES_WITH_DETAILS,
+    STREAM_RENDER_INTERVAL,
     load_prompt_templates
 )
 import streamlit.components.v1 as components
@@ -15,91 +19,94 @@ def save_chat_history(messages, filename=None):
     if filename is None:
         filename = f"chat_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
     
-    # CSVデータを作成
+    # CSVデータを作成（st.download_buttonは全体のデータを要求するため、1つのバッファに書き込む）
     output = io.StringIO()
-    writer = csv.writer(output, quoting=csv.QUOTE_ALL)  # すべてのフィールドをクォート
+    writer = csv.writer(output)  # 改行・カンマを含むフィールドのみクォート
     writer.writerow(["timestamp", "role", "content", "details"])
-    
-    for message in messages:
-        # 行を書き込み
-        writer.writerow([
+    writer.writerows(
+        [
             message.get("timestamp", datetime.now().isoformat()),  # 既存のタイムスタンプがあれば使用
             message["role"],
             message["content"],
-            json.dumps(message.get("details", {}), ensure_ascii=False) if "details" in message else ""
-        ])
+            orjson.dumps(message.get("details", {})).decode() if "details" in message else ""
+        ]
+        for message in messages
+    )
     
     return output.getvalue(), filename
 
 def load_chat_history(file):
     """チャット履歴をCSVファイルから読み込み"""
-    messages = []
-    # ファイルをテキストモードで読み込む
-    content = file.getvalue().decode('utf-8')
-    reader = csv.DictReader(io.StringIO(content))
+    # C実装のパーサーで一括読み込み（空欄はNaNではなく空文字列として扱う）
+    df = pd.read_csv(io.BytesIO(file.getvalue()), dtype=str, keep_default_na=False, encoding="utf-8")
+    messages = df[["timestamp", "role", "content"]].to_dict("records")
     
-    for row in reader:
-        message = {
-            "timestamp": row["timestamp"],
-            "role": row["role"],
-            "content": row["content"]
-        }
-        
-        # detailsが存在する場合はJSONとしてパース
-        if row["details"] and row["details"].strip():
+    # detailsが存在する場合はJSONとしてパース
+    for message, raw_details in zip(messages, df["details"]):
+        if raw_details.strip():
             try:
-                message["details"] = json.loads(row["details"])
-            except json.JSONDecodeError:
+                message["details"] = orjson.loads(raw_details)
+            except orjson.JSONDecodeError:
                 message["details"] = {}
-        
-        messages.append(message)
     
     return messages
 
-def get_property_list(pinecone_service: PineconeService) -> list:
-    """物件情報の一覧を取得"""
-    try:
-        # Pineconeから物件情報の一覧を取得
-        results = pinecone_service.list_vectors(namespace="property")
-        
-        if not results:
-            return []
-            
-        properties = []
-        for match in results:
-            # テキストから物件情報を抽出
-            text = match.metadata["text"]
-            lines = text.split('\n')
-            
-            # 物件名と場所を抽出（最初の2行を想定）
-            name = lines[0].strip() if len(lines) > 0 else "不明"
-            location = lines[1].strip() if len(lines) > 1 else "不明"
-            
-            properties.append({
-                "id": match.id,
-                "name": name,
-                "location": location,
-                "text": text
-            })
-            
-        return properties
-    except Exception as e:
-        st.error(f"物件情報の取得中にエラーが発生しました: {str(e)}")
+def trim_message_details(messages, keep_details: int = MAX_MESSAGES_WITH_DETAILS) -> None:
+    """古いメッセージの詳細情報を省略し、セッション状態の肥大化を防ぐ"""
+    for message in messages[:-keep_details]:
+        details = message.get("details")
+        if not details or details.get("省略"):
+            continue
+        # トークン数のみを残して参照文脈などの大きなデータを破棄
+        elided = {"省略": True}
+        if "トークン数" in details:
+            elided["トークン数"] = details["トークン数"]
+        message["details"] = elided
+
+def to_chat_history_tuples(messages) -> list:
+    """メッセージをLangChainの会話履歴形式（role, content）に変換"""
+    roles = {"user": "human", "assistant": "ai"}
+    return [(roles[msg["role"]], msg["content"]) for msg in messages if msg["role"] in roles]
+
+@st.cache_data(ttl=300, max_entries=8)
+def get_property_list(_pinecone_service: PineconeService, data_version: int) -> list:
+    """物件情報の一覧を取得（5分間キャッシュ。data_versionはキャッシュキー用で、アップロード後は再取得。失敗時は例外を送出しキャッシュしない）"""
+    # Pineconeから物件情報の一覧を取得
+    results = _pinecone_service.list_vectors(namespace="property")
+    
+    if not results:
         return []
+        
+    properties = []
+    for match in results:
+        # テキストから物件情報を抽出
+        text = match.metadata["text"]
+        lines = text.split('\n')
+        
+        # 物件名と場所を抽出（最初の2行を想定）
+        name = lines[0].strip() if len(lines) > 0 else "不明"
+        location = lines[1].strip() if len(lines) > 1 else "不明"
+        
+        properties.append({
+            "id": match.id,
+            "name": name,
+            "location": location,
+            "text": text
+        })
+        
+    return properties
 
-def get_property_info(property_id: str, pinecone_service: PineconeService) -> str:
-    """選択された物件の詳細情報を取得"""
-    try:
-        # Pineconeから物件情報を取得
-        result = pinecone_service.get_by_id(property_id, namespace="property")
+@st.cache_data(ttl=300, max_entries=64)
+def get_property_info(property_id: str, _pinecone_service: PineconeService) -> str:
+    """選択された物件の詳細情報を取得（5分間キャッシュ。取得できなかった場合は例外を送出し、キャッシュしない）"""
+    # Pineconeから物件情報を取得（取得時のエラーでもNoneが返る）
+    result = _pinecone_service.get_by_id(property_id, namespace="property")
+    
+    if not result or "text" not in result:
+        raise LookupError("物件情報が見つかりませんでした。")
         
-        if not result:
-            return "物件情報が見つかりませんでした。"
-            
-        # テキストを取得
-        return result.get("text", "物件情報が見つかりませんでした。")
-    except Exception as e:
-        return f"物件情報の取得中にエラーが発生しました: {str(e)}"
+    # テキストを取得
+    return result["text"]
 
 def get_all_property_info(pinecone_service: PineconeService) -> str:
     """すべての物件情報を取得して結合"""
@@ -130,6 +137,10 @@ def render_chat(pinecone_service: PineconeService):
     # セッション状態の初期化
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    
+    # LangChain形式の会話履歴（メッセージ追加時に逐次更新）
+    if "chat_history_tuples" not in st.session_state:
+        st.session_state.chat_history_tuples = to_chat_history_tuples(st.session_state.messages)
 
     # LangChainサービスの初期化
     if "langchain_service" not in st.session_state:
@@ -142,9 +153,10 @@ def render_chat(pinecone_service: PineconeService):
     search_mode = st.session_state.get("search_mode", "advanced")
     st.session_state.langchain_service.set_search_mode(search_mode == "advanced")
     
-    # プロンプトテンプレートの読み込み（毎回最新の状態を取得）
+    # プロンプトテンプレートの読み込み（ファイルの読み込みはキャッシュされる）
     prompt_templates, _, _ = load_prompt_templates()
     st.session_state.prompt_templates = prompt_templates
+    st.session_state.prompt_templates_by_name = {template["name"]: template for template in prompt_templates}
     
     # サイドバーに履歴管理機能を配置
     with st.sidebar:
@@ -157,7 +169,10 @@ def render_chat(pinecone_service: PineconeService):
         
         # プロンプトテンプレートの選択
         st.header("プロンプトテンプレート")
-        template_names = [template["name"] for template in st.session_state.prompt_templates]
+        if st.button("テンプレートを再読み込み"):
+            load_prompt_templates.clear()
+            st.rerun()
+        template_names = list(st.session_state.prompt_templates_by_name)
         selected_template = st.selectbox(
             "使用するテンプレートを選択",
             template_names,
@@ -165,10 +180,7 @@ def render_chat(pinecone_service: PineconeService):
         )
         
         # 選択されたテンプレートの内容を表示
-        selected_template_data = next(
-            template for template in st.session_state.prompt_templates 
-            if template["name"] == selected_template
-        )
+        selected_template_data = st.session_state.prompt_templates_by_name[selected_template]
         st.subheader("選択中のテンプレート")
         template_tab1, template_tab2 = st.tabs(["システムプロンプト", "応答テンプレート"])
         with template_tab1:
@@ -181,26 +193,36 @@ def render_chat(pinecone_service: PineconeService):
         property_tab1, property_tab2 = st.tabs(["個別選択", "すべて表示"])
         
         with property_tab1:
-            properties = get_property_list(pinecone_service)
+            try:
+                properties = get_property_list(pinecone_service, pinecone_service.data_version)
+            except Exception as e:
+                st.error(f"物件情報の取得中にエラーが発生しました: {str(e)}")
+                properties = []
             
             if properties:
                 # 物件の選択肢を作成（物件名と場所を表示）
-                property_options = [f"{p['name']} - {p['location']}" for p in properties]
+                property_id_by_label = {f"{p['name']} - {p['location']}": p["id"] for p in properties}
                 selected_property = st.selectbox(
                     "物件を選択",
-                    options=property_options,
+                    options=list(property_id_by_label),
                     index=0
                 )
                 
                 # 選択された物件のIDを取得
-                selected_property_id = properties[property_options.index(selected_property)]["id"]
+                selected_property_id = property_id_by_label[selected_property]
                 
-                # 選択された物件の詳細情報を取得
-                st.session_state.property_info = get_property_info(selected_property_id, pinecone_service)
+                # 物件の詳細情報を取得（成功した結果のみキャッシュされるため、失敗時は次回の再実行で再取得される）
+                try:
+                    st.session_state.selected_property_info = get_property_info(selected_property_id, pinecone_service)
+                except LookupError as e:
+                    st.session_state.selected_property_info = str(e)
+                except Exception as e:
+                    st.session_state.selected_property_info = f"物件情報の取得中にエラーが発生しました: {str(e)}"
+                st.session_state.property_info = st.session_state.selected_property_info
                 
                 # 物件の詳細情報を表示（expanderで折りたたみ）
                 with st.expander("選択中の物件情報", expanded=False):
-                    st.markdown(st.session_state.property_info)
+                    st.markdown(st.session_state.selected_property_info)
             else:
                 st.warning("物件情報が登録されていません。")
                 st.session_state.property_info = "物件情報が登録されていません。"
@@ -217,7 +239,12 @@ def render_chat(pinecone_service: PineconeService):
         # 履歴の保存 (ローカルダウンロード)
         st.write(f"現在のメッセージ数: {len(st.session_state.messages)}")
         if len(st.session_state.messages) > 0:
-            csv_data, filename = save_chat_history(st.session_state.messages)
+            # 履歴が変わった場合のみCSVを作り直す（再実行のたびにdetailsをシリアライズしない）
+            history_key = (len(st.session_state.messages), st.session_state.messages[-1].get("timestamp"))
+            if st.session_state.get("_history_csv_key") != history_key:
+                st.session_state._history_csv = save_chat_history(st.session_state.messages)
+                st.session_state._history_csv_key = history_key
+            csv_data, filename = st.session_state._history_csv
             st.download_button(
                 label="履歴をダウンロード",
                 data=csv_data,
@@ -237,14 +264,16 @@ def render_chat(pinecone_service: PineconeService):
                 
                 # セッション状態を更新
                 st.session_state.messages = loaded_messages.copy()
+                trim_message_details(st.session_state.messages)
+                st.session_state.chat_history_tuples = to_chat_history_tuples(loaded_messages)
                 
                 # LangChainの会話履歴を更新
                 st.session_state.langchain_service.clear_memory()
-                for message in loaded_messages:
-                    if message["role"] == "user":
-                        st.session_state.langchain_service.message_history.add_user_message(message["content"])
-                    elif message["role"] == "assistant":
-                        st.session_state.langchain_service.message_history.add_ai_message(message["content"])
+                st.session_state.langchain_service.message_history.messages = [
+                    HumanMessage(content=message["content"]) if message["role"] == "user" else AIMessage(content=message["content"])
+                    for message in loaded_messages
+                    if message["role"] in ("user", "assistant")
+                ]
                 
                 st.session_state.load_history = True
                 st.success("履歴を読み込みました")
@@ -255,6 +284,7 @@ def render_chat(pinecone_service: PineconeService):
         # 履歴のクリア
         if st.button("履歴をクリア"):
             st.session_state.messages = []
+            st.session_state.chat_history_tuples = []
             st.session_state.langchain_service.clear_memory()
             if "load_history" in st.session_state:
                 del st.session_state.load_history
@@ -263,12 +293,12 @@ def render_chat(pinecone_service: PineconeService):
     
     # メインコンテンツ
     # メインのチャット表示
-    for message in st.session_state.messages:
+    for message_index, message in enumerate(st.session_state.messages):
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
             if "details" in message and message["details"]:
-                # 詳細情報を表示するボタン
-                if st.button("詳細情報を表示", key=f"details_{message['timestamp']}"):
+                # 詳細情報は折りたたんで表示
+                with st.expander("詳細情報", expanded=False):
                     details = message["details"]
                     
                     # タブを使用して詳細情報を表示
@@ -283,39 +313,28 @@ def render_chat(pinecone_service: PineconeService):
                     with tabs[1]:
                         if "送信テキスト" in details:
                             sent_text = details["送信テキスト"]
-                            st.text_area("システムプロンプト", sent_text["システムプロンプト"], height=100)
-                            st.text_area("チャット履歴", "\n".join([f"[{msg['type']}]: {msg['content']}" for msg in sent_text["チャット履歴"]]), height=200)
-                            st.text_area("参照文脈", sent_text["参照文脈"], height=100)
+                            st.text_area("システムプロンプト", sent_text["システムプロンプト"], height=100, key=f"system_prompt_{message_index}")
+                            st.text_area("チャット履歴", "\n".join([f"[{msg['type']}]: {msg['content']}" for msg in sent_text["チャット履歴"]]), height=200, key=f"chat_history_{message_index}")
+                            st.text_area("参照文脈", sent_text["参照文脈"], height=100, key=f"context_{message_index}")
                             
-                            # 参照文脈の詳細情報を表示
-                            if "参照文脈の詳細" in sent_text:
+                            # 参照文脈の詳細情報を表示（1つの表にまとめる）
+                            if sent_text.get("参照文脈の詳細"):
                                 st.markdown("**参照文脈の詳細**")
-                                for i, detail in enumerate(sent_text["参照文脈の詳細"], 1):
-                                    st.markdown(f"**参照 {i}**")
-                                    st.write(f"ファイル名: {detail['ファイル名']}")
-                                    st.write(f"ページ番号: {detail['ページ番号']}")
-                                    st.write(f"セクション: {detail['セクション']}")
-                                    
-                                    # 高度な検索の結果を表示
-                                    if "スコア" in detail:
-                                        st.write(f"調整されたスコア: {detail['スコア']}")
-                                    if "元のスコア" in detail:
-                                        st.write(f"元のスコア: {detail['元のスコア']}")
-                                    if "クエリバリエーション" in detail:
-                                        st.write(f"使用されたクエリ: {detail['クエリバリエーション']}")
-                                    if "クエリ順序" in detail:
-                                        st.write(f"クエリ順序: {detail['クエリ順序']}")
-                                    
-                                    # 質問文例の表示
-                                    if "質問文例" in detail and detail["質問文例"]:
-                                        st.write("**質問文例:**")
-                                        for i, question in enumerate(detail["質問文例"], 1):
-                                            st.write(f"{i}. {question}")
-                                    
-                                    st.text_area(f"テキスト {i}", detail['テキスト'], height=100)
+                                reference_columns = [
+                                    "ファイル名", "ページ番号", "セクション", "スコア", "元のスコア",
+                                    "クエリバリエーション", "クエリ順序", "質問文例", "テキスト"
+                                ]
+                                reference_rows = [
+                                    {
+                                        column: "\n".join(detail[column]) if isinstance(detail[column], list) else detail[column]
+                                        for column in reference_columns if column in detail
+                                    }
+                                    for detail in sent_text["参照文脈の詳細"]
+                                ]
+                                st.dataframe(pd.DataFrame(reference_rows), hide_index=True)
                             
-                            st.text_area("物件情報", sent_text["物件情報"], height=100)
-                            st.text_area("ユーザー入力", sent_text["ユーザー入力"], height=100)
+                            st.text_area("物件情報", sent_text["物件情報"], height=100, key=f"property_info_{message_index}")
+                            st.text_area("ユーザー入力", sent_text["ユーザー入力"], height=100, key=f"user_input_{message_index}")
                     
                     # その他の情報タブ
                     with tabs[2]:
@@ -332,34 +351,39 @@ def render_chat(pinecone_service: PineconeService):
             "content": prompt,
             "timestamp": datetime.now().isoformat()
         })
+        st.session_state.chat_history_tuples.append(("human", prompt))
         
-        # 選択されたテンプレートを取得
-        selected_template_data = next(
-            template for template in st.session_state.prompt_templates 
-            if template["name"] == selected_template
-        )
+        property_info = st.session_state.get("property_info", "物件情報はありません。")
         
         # LangChainを使用して応答を生成
         with st.spinner("応答を生成中..."):
-            # 会話履歴をLangChainのメッセージ形式に変換
-            chat_history = []
-            for msg in st.session_state.messages:  # すべてのメッセージを含める
-                if msg["role"] == "user":
-                    chat_history.append(("human", msg["content"]))
-                elif msg["role"] == "assistant":
-                    chat_history.append(("ai", msg["content"]))
-            
             # 会話履歴を逆順にして、最新の会話から処理
-            chat_history.reverse()
+            chat_history = reversed(st.session_state.chat_history_tuples)
+            
+            # 生成中の応答を逐次表示（トークンごとに全文を描画し直さないよう、一定間隔・改行ごとに更新）
+            with st.chat_message("user"):
+                st.markdown(prompt)
+            with st.chat_message("assistant"):
+                response_placeholder = st.empty()
+            streamed_response = []
+            
+            def show_partial_response(token: str):
+                streamed_response.append(token)
+                if "\n" in token or len(streamed_response) % STREAM_RENDER_INTERVAL == 0:
+                    response_placeholder.markdown("".join(streamed_response))
             
             response, details = st.session_state.langchain_service.get_response(
                 prompt,
                 system_prompt=selected_template_data["system_prompt"],
                 response_template=selected_template_data["response_template"],
-                property_info=st.session_state.get("property_info", "物件情報はありません。"),
-                chat_history=chat_history  # 会話履歴を渡す
+                property_info=property_info,
+                chat_history=chat_history,  # 会話履歴を渡す
+                on_token=show_partial_response
             )
             
+            # 最後の間隔に満たない部分を含めて、応答全体を表示
+            response_placeholder.markdown(response)
+            
             # アシスタントの応答を追加
             st.session_state.messages.append({
                 "role": "assistant",
@@ -367,5 +391,7 @@ def render_chat(pinecone_service: PineconeService):
                 "details": details,
                 "timestamp": datetime.now().isoformat()
             })
+            st.session_state.chat_history_tuples.append(("ai", response))
+            trim_message_details(st.session_state.messages)
         
         st.rerun() 
\ No newline at end of file
@@ -1,10 +1,13 @@
 import streamlit as st
 from src.services.pinecone_service import PineconeService
 import pandas as pd
-import json
+import re
 import traceback
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import tiktoken
+from src.config.settings import BATCH_SIZE
 
 # 都道府県と市区町村のデータ
 PREFECTURES = [
@@ -19,10 +22,42 @@ CITIES = {
     # 他の都道府県の市区町村も同様に追加可能
 }
 
+# 文末（。！？!?）で分割するための正規表現（1回の走査ですべての区切りを処理）
+# 文間の空白は次の文の先頭に残し、結合したときに英文の単語が連結されないようにする
+_SENTENCE_SPLIT = re.compile(r'(?<=[。！？!?])')
+
+# 1文が長すぎる場合に分割位置として使う区切り文字
+_FALLBACK_DELIMITERS = ("、", "，", " ", "　")
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    """tiktokenのエンコーダーを取得（モデルごとに一度だけ生成）"""
+    return tiktoken.encoding_for_model(model)
+
+def _format_property_header(base_info: dict) -> str:
+    """埋め込み用テキストの共通部分を作成（1行目: 物件名、2行目: 所在地、3行目: 物件種別）"""
+    return "\n".join([
+        base_info["property_name"],
+        f"{base_info['prefecture']}{base_info['city']}{base_info['detailed_address']}",
+        f"物件種別: {base_info['property_type']}"
+    ])
+
+def _split_long_sentence(sentence: str, max_chars: int) -> list:
+    """上限を超える文を、上限手前の読点・空白で分割する"""
+    pieces = []
+    start = 0
+    while len(sentence) - start > max_chars:
+        end = start + max_chars
+        # 上限位置に最も近い区切り文字を探す（見つからなければ上限位置で分割）
+        split_at = max(sentence.rfind(d, start + 1, end) for d in _FALLBACK_DELIMITERS)
+        split_at = split_at + 1 if split_at > start else end
+        pieces.append(sentence[start:split_at])
+        start = split_at
+    pieces.append(sentence[start:])
+    return pieces
+
 def split_property_data(property_data: dict, max_tokens: int = 2000) -> list:
     """物件データを複数のチャンクに分割する"""
-    encoding = tiktoken.encoding_for_model("text-embedding-3-large")
-    
     # 基本情報（常に含める）
     base_info = {
         "property_name": property_data["property_name"],
@@ -34,37 +69,64 @@ def split_property_data(property_data: dict, max_tokens: int = 2000) -> list:
         "longitude": property_data.get("longitude", "0.0")
     }
     
+    # 全チャンクで共通のテキスト部分は一度だけ作成
+    header = _format_property_header(base_info)
+    
     # 詳細情報を分割
     details = property_data.get("property_details", "")
     if not details:
-        return [{"text": json.dumps(base_info, ensure_ascii=False), "metadata": base_info}]
+        return [{"text": header, "metadata": base_info}]
     
     # 詳細情報を段落で分割
-    paragraphs = [p.strip() for p in details.split('\n') if p.strip()]
-    print(f"段落数: {len(paragraphs)}")
+    paragraphs = [p for p in map(str.strip, details.splitlines()) if p]
     
-    # 段落をさらに細かく分割
+    # トークン数はUTF-8のバイト数を超えないため、全体が収まることが明らかならトークナイザーを使わない
+    joined_details = "\n".join(paragraphs)
+    single_text = f"{header}\n{joined_details}"
+    if len(single_text.encode("utf-8")) <= max_tokens:
+        chunk_info = {**base_info, "property_details": joined_details, "chunk_number": 1, "total_chunks": 1}
+        return [{"text": single_text, "metadata": chunk_info}]
+    
+    encoding = _get_encoding("text-embedding-3-large")
+    
+    # 区切り文字と共通部分のトークン数は一度だけ計算し、詳細情報に使える上限を求める
+    sep_tokens = len(encoding.encode_ordinary("\n"))
+    details_max_tokens = max_tokens - len(encoding.encode_ordinary(header)) - sep_tokens
+    
+    # 段落のトークン数をまとめて計算（特殊トークンは含まれないためordinaryで十分）
+    paragraph_token_counts = [len(t) for t in encoding.encode_ordinary_batch(paragraphs)]
+    
+    # 段落をさらに細かく分割（各段落のトークン数も合わせて保持）
     split_paragraphs = []
-    for paragraph in paragraphs:
-        # 段落のトークン数を計算
-        paragraph_tokens = len(encoding.encode(paragraph))
-        print(f"段落のトークン数: {paragraph_tokens}")
-        
-        if paragraph_tokens <= max_tokens:
+    para_tokens = []
+    for paragraph, paragraph_tokens in zip(paragraphs, paragraph_token_counts):
+        if paragraph_tokens <= details_max_tokens:
             split_paragraphs.append(paragraph)
+            para_tokens.append(paragraph_tokens)
         else:
             # 段落を文で分割
-            sentences = [s.strip() for s in paragraph.replace('。', '。\n').split('\n') if s.strip()]
+            sentences = [s for s in _SENTENCE_SPLIT.split(paragraph) if s]
+            sentence_token_counts = [len(t) for t in encoding.encode_ordinary_batch(sentences)]
+            
+            # 1文で上限を超える場合は読点・空白で更に分割
+            if any(count > details_max_tokens for count in sentence_token_counts):
+                pieces = []
+                for sentence, sentence_tokens in zip(sentences, sentence_token_counts):
+                    if sentence_tokens > details_max_tokens:
+                        max_chars = max(1, int(len(sentence) * details_max_tokens / sentence_tokens * 0.9))
+                        pieces.extend(_split_long_sentence(sentence, max_chars))
+                    else:
+                        pieces.append(sentence)
+                sentences = pieces
+                sentence_token_counts = [len(t) for t in encoding.encode_ordinary_batch(sentences)]
             current_sentence_group = []
             current_group_tokens = 0
             
-            for sentence in sentences:
-                sentence_tokens = len(encoding.encode(sentence))
-                print(f"文のトークン数: {sentence_tokens}")
-                
-                if current_group_tokens + sentence_tokens > max_tokens:
+            for sentence, sentence_tokens in zip(sentences, sentence_token_counts):
+                if current_group_tokens + sentence_tokens > details_max_tokens:
                     if current_sentence_group:
-                        split_paragraphs.append(''.join(current_sentence_group))
+                        split_paragraphs.append(''.join(current_sentence_group).strip())
+                        para_tokens.append(current_group_tokens)
                     current_sentence_group = [sentence]
                     current_group_tokens = sentence_tokens
                 else:
@@ -72,77 +134,47 @@ def split_property_data(property_data: dict, max_tokens: int = 2000) -> list:
                     current_group_tokens += sentence_tokens
             
             if current_sentence_group:
-                split_paragraphs.append(''.join(current_sentence_group))
-    
-    print(f"分割後の段落数: {len(split_paragraphs)}")
+                split_paragraphs.append(''.join(current_sentence_group).strip())
+                para_tokens.append(current_group_tokens)
     
     # 段落を意味のある単位でグループ化
-    chunks = []
+    chunk_groups = []
     current_chunk = []
     current_length = 0
     
-    for i, paragraph in enumerate(split_paragraphs):
-        # 段落のトークン数を計算
-        paragraph_tokens = len(encoding.encode(paragraph))
-        print(f"段落 {i+1}/{len(split_paragraphs)} のトークン数: {paragraph_tokens}")
-        
-        # 現在のチャンクに追加した場合の長さを計算
+    for paragraph, paragraph_tokens in zip(split_paragraphs, para_tokens):
+        # 現在のチャンクに追加した場合の長さを計算（結合後の再エンコードを避けるため加算で計算）
         if current_chunk:
-            test_text = "\n".join(current_chunk + [paragraph])
+            test_tokens = current_length + sep_tokens + paragraph_tokens
         else:
-            test_text = paragraph
-        
-        test_tokens = len(encoding.encode(test_text))
-        print(f"現在のチャンク + 段落のトークン数: {test_tokens}")
+            test_tokens = paragraph_tokens
         
         # チャンクの長さが制限を超える場合、新しいチャンクを開始
-        if test_tokens > max_tokens:
-            if current_chunk:
-                # 現在のチャンクを保存
-                chunk_info = base_info.copy()
-                chunk_info["property_details"] = "\n".join(current_chunk)
-                chunk_info["chunk_number"] = len(chunks) + 1
-                
-                # チャンクのトークン数を確認
-                chunk_text = json.dumps(chunk_info, ensure_ascii=False)
-                chunk_tokens = len(encoding.encode(chunk_text))
-                print(f"チャンク {len(chunks) + 1} のトークン数: {chunk_tokens}")
-                
-                chunk = {
-                    "text": chunk_text,
-                    "metadata": chunk_info
-                }
-                chunks.append(chunk)
-            
-            # 新しいチャンクを開始
+        if test_tokens > details_max_tokens and current_chunk:
+            chunk_groups.append(current_chunk)
             current_chunk = [paragraph]
             current_length = paragraph_tokens
         else:
             current_chunk.append(paragraph)
             current_length = test_tokens
     
-    # 最後のチャンクを処理
     if current_chunk:
-        chunk_info = base_info.copy()
-        chunk_info["property_details"] = "\n".join(current_chunk)
-        chunk_info["chunk_number"] = len(chunks) + 1
-        
-        # チャンクのトークン数を確認
-        chunk_text = json.dumps(chunk_info, ensure_ascii=False)
-        chunk_tokens = len(encoding.encode(chunk_text))
-        print(f"最後のチャンクのトークン数: {chunk_tokens}")
-        
-        chunk = {
-            "text": chunk_text,
-            "metadata": chunk_info
-        }
-        chunks.append(chunk)
+        chunk_groups.append(current_chunk)
     
-    # 総チャンク数を更新
-    for chunk in chunks:
-        chunk["metadata"]["total_chunks"] = len(chunks)
+    # グループごとにチャンクを作成（総チャンク数も同時に設定）
+    chunks = []
+    for chunk_number, group in enumerate(chunk_groups, 1):
+        chunk_details = "\n".join(group)
+        chunks.append({
+            "text": f"{header}\n{chunk_details}",
+            "metadata": {
+                **base_info,
+                "property_details": chunk_details,
+                "chunk_number": chunk_number,
+                "total_chunks": len(chunk_groups)
+            }
+        })
     
-    print(f"最終的なチャンク数: {len(chunks)}")
     return chunks
 
 def render_property_upload(pinecone_service: PineconeService):
@@ -234,12 +266,21 @@ def render_property_upload(pinecone_service: PineconeService):
                 for i, chunk in enumerate(chunks):
                     chunk["id"] = f"property_{timestamp}_{i}"
                 
-                # Pineconeへのアップロード
-                pinecone_service.upload_chunks(chunks, namespace="property")
+                # Pineconeへのアップロード（バッチごとに並列で埋め込み生成・登録）
+                batches = [chunks[i:i + BATCH_SIZE] for i in range(0, len(chunks), BATCH_SIZE)]
+                progress_bar = st.progress(0.0, text="アップロード中...")
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    futures = [
+                        executor.submit(pinecone_service.upload_chunks, batch, namespace="property")
+                        for batch in batches
+                    ]
+                    for done, future in enumerate(as_completed(futures), 1):
+                        future.result()
+                        progress_bar.progress(done / len(batches), text=f"アップロード中... ({done}/{len(batches)}バッチ)")
                 
                 st.success(f"✅ 物件情報を{len(chunks)}件のチャンクに分割してアップロードしました")
                 
             except Exception as e:
-                st.error(f"❌ アップロードに失敗しました: {str(e)}")
-                st.error(f"🔍 エラーの詳細: {type(e).__name__}")
-                st.error(f"📜 スタックトレース:\n{traceback.format_exc()}") 
\ No newline at end of file
+                # スタックトレースはサーバーログにのみ出力し、画面には要約を表示
+                traceback.print_exc()
+                st.error(f"❌ アップロードに失敗しました（{type(e).__name__}）: {str(e)}") 
\ No newline at end of file
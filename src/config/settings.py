@@ -31,6 +31,19 @@ EMBEDDING_DIMENSION = 3072  # 埋め込みベクトルの次元数
 DEFAULT_TOP_K = 10  # デフォルトの検索結果数
 SIMILARITY_THRESHOLD = 0.4  # 類似度のしきい値（0-1の範囲）
 
+# Cache Settings
+QUERY_ANALYSIS_CACHE_SIZE = 256  # キーワード抽出・クエリバリエーションのキャッシュの最大件数
+SEMANTIC_CACHE_SIZE = 256  # 類似クエリの検索結果キャッシュの最大件数
+SEMANTIC_CACHE_THRESHOLD = 0.9  # 検索結果を再利用するクエリ間のコサイン類似度のしきい値
+SEMANTIC_CACHE_TTL = 6 * 60 * 60  # 検索結果キャッシュの有効期限（秒）
+EMBEDDING_CACHE_SIZE = 256  # クエリの埋め込みベクトルのキャッシュの最大件数（全セッションで共有）
+CHAIN_CACHE_SIZE = 16  # セッションごとに保持する構築済みプロンプトチェーンの最大件数
+
+# Chat Settings
+MAX_MESSAGES_WITH_DETAILS = 50  # 詳細情報を保持する直近のメッセージ数
+STREAM_RENDER_INTERVAL = 8  # 生成中の応答を再描画するトークン数の間隔（改行を受信した場合は間隔に関わらず再描画）
+DEBUG_MODE = os.getenv("APP_DEBUG") == "1"  # 検索結果のメタデータ全体など、デバッグ用の詳細情報を保持・出力するか
+
 # Metadata Settings
 DEFAULT_CREATION_DATE = datetime.now().strftime("%Y-%m-%d %H:%M:%S")  # メタデータの作成日が空の場合のデフォルト値
 
@@ -51,9 +64,12 @@ def save_prompt_templates(templates):
     """プロンプトテンプレートを保存"""
     with open(PROMPT_TEMPLATES_FILE, "w", encoding="utf-8") as f:
         json.dump(templates, f, ensure_ascii=False, indent=2)
+    # 保存した内容がすぐに反映されるようにキャッシュを破棄
+    load_prompt_templates.clear()
 
+@st.cache_data(ttl=60)
 def load_prompt_templates():
-    """プロンプトテンプレートを読み込み"""
+    """プロンプトテンプレートを読み込み（60秒間キャッシュ）"""
     if os.path.exists(PROMPT_TEMPLATES_FILE):
         with open(PROMPT_TEMPLATES_FILE, "r", encoding="utf-8") as f:
             templates = json.load(f)
@@ -1,24 +1,69 @@
 from typing import List, Dict, Any, Tuple
-from openai import OpenAI
 import re
-import json
+import unicodedata
+import orjson
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from src.services.pinecone_service import PineconeService
-from src.config.settings import OPENAI_API_KEY, SIMILARITY_THRESHOLD
+from src.services.openai_client import get_openai_client
+from src.config.settings import SIMILARITY_THRESHOLD, QUERY_ANALYSIS_CACHE_SIZE
 import streamlit as st
 
+# 日本語の重要なキーワードパターン（1回の走査で全パターンを検索できるよう結合してコンパイル）
+_BASIC_KEYWORD_PATTERN = re.compile("|".join([
+    r'小学校|中学校|高校|大学|学校',
+    r'保育園|幼稚園|学童',
+    r'病院|クリニック|診療所',
+    r'スーパー|コンビニ|ショッピング',
+    r'駅|バス停|交通',
+    r'公園|遊び場|施設',
+    r'近く|周辺|地域|エリア',
+    r'川越|さいたま|埼玉|東京|神奈川|千葉'
+]))
+
 class AdvancedSearchService:
     def __init__(self, pinecone_service: PineconeService):
         """高度な検索サービスの初期化"""
         self.pinecone_service = pinecone_service
-        self.openai_client = OpenAI(api_key=OPENAI_API_KEY)
+        self.openai_client = get_openai_client()
         
         # 検索設定
         self.base_similarity_threshold = SIMILARITY_THRESHOLD
         self.max_query_variations = 5
         self.max_results_per_query = 10
+        self.simple_query_max_length = 40  # この文字数未満で基本キーワードを含むクエリはLLMによる解析を省略
+        
+        # LLMによるキーワード抽出・クエリバリエーション生成の結果キャッシュ（LRU）
+        self._keyword_cache = OrderedDict()
+        self._variation_cache = OrderedDict()
+    
+    @staticmethod
+    def _normalize_query(query: str) -> str:
+        """キャッシュキー用にクエリを正規化"""
+        return unicodedata.normalize("NFKC", query).strip().lower()
+    
+    @staticmethod
+    def _cache_get(cache: OrderedDict, key):
+        """キャッシュから取得（ヒットした場合は最近使用したものとして扱う）"""
+        if key not in cache:
+            return None
+        cache.move_to_end(key)
+        return list(cache[key])
+    
+    @staticmethod
+    def _cache_put(cache: OrderedDict, key, value: List[str]) -> None:
+        """キャッシュに保存（上限を超えた場合は最も古いものを削除）"""
+        cache[key] = list(value)
+        if len(cache) > QUERY_ANALYSIS_CACHE_SIZE:
+            cache.popitem(last=False)
         
     def extract_keywords(self, query: str) -> List[str]:
         """クエリから重要なキーワードを抽出"""
+        cache_key = self._normalize_query(query)
+        cached_keywords = self._cache_get(self._keyword_cache, cache_key)
+        if cached_keywords is not None:
+            return cached_keywords
+        
         try:
             # OpenAIを使用してキーワード抽出
             response = self.openai_client.chat.completions.create(
@@ -30,13 +75,14 @@ class AdvancedSearchService:
                 response_format={"type": "json_object"}
             )
             
-            result = json.loads(response.choices[0].message.content)
+            result = orjson.loads(response.choices[0].message.content)
             keywords = result.get("keywords", [])
             
             # 基本的なキーワードも追加
             basic_keywords = self._extract_basic_keywords(query)
             all_keywords = list(set(keywords + basic_keywords))
             
+            self._cache_put(self._keyword_cache, cache_key, all_keywords)
             return all_keywords
             
         except Exception as e:
@@ -45,27 +91,15 @@ class AdvancedSearchService:
     
     def _extract_basic_keywords(self, query: str) -> List[str]:
         """基本的なキーワード抽出（フォールバック）"""
-        # 日本語の重要なキーワードパターン
-        patterns = [
-            r'小学校|中学校|高校|大学|学校',
-            r'保育園|幼稚園|学童',
-            r'病院|クリニック|診療所',
-            r'スーパー|コンビニ|ショッピング',
-            r'駅|バス停|交通',
-            r'公園|遊び場|施設',
-            r'近く|周辺|地域|エリア',
-            r'川越|さいたま|埼玉|東京|神奈川|千葉'
-        ]
-        
-        keywords = []
-        for pattern in patterns:
-            matches = re.findall(pattern, query)
-            keywords.extend(matches)
-        
-        return list(set(keywords))
+        return list(set(_BASIC_KEYWORD_PATTERN.findall(query)))
     
     def generate_query_variations(self, query: str, keywords: List[str]) -> List[str]:
         """クエリのバリエーションを生成"""
+        cache_key = (self._normalize_query(query), tuple(sorted(keywords)))
+        cached_variations = self._cache_get(self._variation_cache, cache_key)
+        if cached_variations is not None:
+            return cached_variations
+        
         variations = [query]  # 元のクエリを最初に追加
         
         try:
@@ -79,16 +113,22 @@ class AdvancedSearchService:
                 response_format={"type": "json_object"}
             )
             
-            result = json.loads(response.choices[0].message.content)
+            result = orjson.loads(response.choices[0].message.content)
             variations.extend(result.get("variations", []))
+            generated = True
             
         except Exception as e:
             print(f"クエリバリエーション生成エラー: {str(e)}")
             # フォールバック: キーワードベースのバリエーション
             variations.extend(self._generate_basic_variations(query, keywords))
+            generated = False
         
         # 重複を除去して制限数まで
         unique_variations = list(dict.fromkeys(variations))[:self.max_query_variations]
+        
+        # LLMで生成できた場合のみキャッシュ（フォールバック結果は次回再試行する）
+        if generated:
+            self._cache_put(self._variation_cache, cache_key, unique_variations)
         return unique_variations
     
     def _generate_basic_variations(self, query: str, keywords: List[str]) -> List[str]:
@@ -109,56 +149,68 @@ class AdvancedSearchService:
         
         return variations
     
-    def multi_step_search(self, query: str, namespace: str = None) -> Dict[str, Any]:
-        """マルチステップ検索を実行"""
+    def multi_step_search(self, query: str, namespace: str = None, query_vector: List[float] = None) -> Dict[str, Any]:
+        """マルチステップ検索を実行（query_vectorを渡すと元のクエリのベクトル化を省略）"""
         print(f"\n=== マルチステップ検索開始 ===")
         print(f"クエリ: {query}")
         
-        # ステップ1: キーワード抽出
-        print("\nステップ1: キーワード抽出")
-        keywords = self.extract_keywords(query)
-        print(f"抽出されたキーワード: {keywords}")
-        
-        # ステップ2: クエリバリエーション生成
-        print("\nステップ2: クエリバリエーション生成")
-        query_variations = self.generate_query_variations(query, keywords)
-        print(f"生成されたクエリバリエーション: {query_variations}")
-        
-        # ステップ3: 複数クエリでの検索
-        print("\nステップ3: 複数クエリでの検索")
-        all_results = []
+        # 設定画面のしきい値はワーカースレッドから参照できないため、リクエストごとに一度だけ取得
+        current_threshold = st.session_state.get("similarity_threshold", self.base_similarity_threshold)
         
-        for i, variation in enumerate(query_variations):
-            print(f"\nクエリバリエーション {i+1}: {variation}")
+        with ThreadPoolExecutor(max_workers=self.max_query_variations) as executor:
+            # 元のクエリの検索はキーワード・バリエーションに依存しないため、LLMの処理を待たずに開始
+            original_future = executor.submit(
+                self._search_variation, 0, query, query_vector, namespace, current_threshold
+            )
             
-            # 動的しきい値調整
-            similarity_threshold = self.base_similarity_threshold
-            if i > 0:  # 2番目以降のクエリはしきい値を下げる
-                similarity_threshold = max(0.2, similarity_threshold - 0.1)
+            # ステップ1・2: キーワード抽出とクエリバリエーション生成
+            print("\nステップ1・2: キーワード抽出とクエリバリエーション生成")
+            basic_keywords = self._extract_basic_keywords(query)
+            if basic_keywords and len(query) < self.simple_query_max_length:
+                # 短く基本キーワードで十分なクエリは、LLMを使わずそのまま検索
+                keywords = basic_keywords
+                query_variations = [query]
+            else:
+                # バリエーション生成には、LLMで抽出したキーワードを使用
+                keywords = self.extract_keywords(query)
+                query_variations = self.generate_query_variations(query, keywords)
+            print(f"抽出されたキーワード: {keywords}")
+            print(f"生成されたクエリバリエーション: {query_variations}")
             
+            # ステップ3: 複数クエリでの検索（元のクエリは常に先頭にあり、検索済み）
+            print("\nステップ3: 複数クエリでの検索")
+            other_variations = query_variations[1:]
+            
+            # 残りのバリエーションの埋め込みベクトルを1回のリクエストで取得
             try:
-                results = self.pinecone_service.query(
-                    query_text=variation,
-                    namespace=namespace,
-                    top_k=self.max_results_per_query,
-                    similarity_threshold=similarity_threshold
-                )
-                
-                # 結果にクエリ情報を追加
-                for match in results["matches"]:
-                    match.query_variation = variation
-                    match.query_index = i
-                
-                all_results.extend(results["matches"])
-                print(f"  結果数: {len(results['matches'])}")
-                
+                other_vectors = self.pinecone_service.get_embeddings(other_variations) if other_variations else []
             except Exception as e:
-                print(f"  検索エラー: {str(e)}")
-                continue
+                # 一括取得に失敗した場合は各検索でベクトル化する
+                print(f"  埋め込みベクトルの一括取得エラー: {str(e)}")
+                other_vectors = [None] * len(other_variations)
+            
+            # 動的しきい値調整（2番目以降のクエリはしきい値を下げる）
+            other_threshold = max(0.2, self.base_similarity_threshold - 0.1)
+            other_results = executor.map(
+                self._search_variation,
+                range(1, len(query_variations)),
+                other_variations,
+                other_vectors,
+                [namespace] * len(other_variations),
+                [other_threshold] * len(other_variations)
+            )
+            
+            # 結果を元の順序で統合（重複除去はIDベース、スコアが最も高い結果のみを保持）
+            unique_results = {}
+            for matches in [original_future.result(), *other_results]:
+                for match in matches:
+                    best_match = unique_results.get(match.id)
+                    if best_match is None or match.score > best_match.score:
+                        unique_results[match.id] = match
         
         # ステップ4: 結果の統合とランキング
         print("\nステップ4: 結果の統合とランキング")
-        final_results = self._merge_and_rank_results(all_results, query_variations)
+        final_results = self._merge_and_rank_results(unique_results, query_variations, current_threshold)
         
         print(f"\n=== 検索完了 ===")
         print(f"最終結果数: {len(final_results)}")
@@ -173,45 +225,54 @@ class AdvancedSearchService:
             }
         }
     
-    def _merge_and_rank_results(self, all_results: List, query_variations: List[str]) -> List:
-        """検索結果を統合してランキング"""
-        if not all_results:
+    def _search_variation(self, index: int, variation: str, query_vector: List[float], namespace: str, similarity_threshold: float) -> List:
+        """1つのクエリバリエーションで検索（エラー時は空のリストを返す）"""
+        try:
+            if query_vector is None:
+                results = self.pinecone_service.query(
+                    query_text=variation,
+                    namespace=namespace,
+                    top_k=self.max_results_per_query,
+                    similarity_threshold=similarity_threshold
+                )
+            else:
+                results = self.pinecone_service.query_by_vector(
+                    query_vector,
+                    namespace=namespace,
+                    top_k=self.max_results_per_query,
+                    similarity_threshold=similarity_threshold
+                )
+        except Exception as e:
+            print(f"  検索エラー（クエリバリエーション {index+1}: {variation}）: {str(e)}")
             return []
         
-        # 重複除去（IDベース）
-        unique_results = {}
-        for result in all_results:
-            result_id = result.id
-            if result_id not in unique_results:
-                unique_results[result_id] = result
-            else:
-                # 既存の結果よりスコアが高い場合は更新
-                if result.score > unique_results[result_id].score:
-                    unique_results[result_id] = result
+        # 結果にクエリ情報を追加
+        for match in results["matches"]:
+            match.query_variation = variation
+            match.query_index = index
         
-        # スコアの正規化とランキング
+        print(f"  クエリバリエーション {index+1}: {variation} 結果数: {len(results['matches'])}")
+        return results["matches"]
+    
+    def _merge_and_rank_results(self, unique_results: Dict[str, Any], query_variations: List[str], current_threshold: float = None) -> List:
+        """検索結果（IDごとに重複除去済み）を統合してランキング"""
+        if not unique_results:
+            return []
+        
+        if current_threshold is None:
+            current_threshold = self.base_similarity_threshold
+        
+        # クエリバリエーションの順序を考慮したスコア調整（後半のクエリは少しペナルティ）と
+        # しきい値でのフィルタリングを1回の走査で行い、残った結果のみをソート
         ranked_results = []
         for result in unique_results.values():
-            # クエリバリエーションの順序を考慮したスコア調整
-            query_penalty = result.query_index * 0.05  # 後半のクエリは少しペナルティ
-            
-            adjusted_score = result.score - query_penalty
-            
-            # 調整されたスコアを追加
-            result.adjusted_score = adjusted_score
-            ranked_results.append(result)
+            result.adjusted_score = result.score - result.query_index * 0.05
+            if result.adjusted_score >= current_threshold:
+                ranked_results.append(result)
         
-        # 調整されたスコアでソート
         ranked_results.sort(key=lambda x: x.adjusted_score, reverse=True)
         
-        # 設定画面のしきい値でフィルタリング
-        current_threshold = st.session_state.get("similarity_threshold", self.base_similarity_threshold)
-        filtered_results = [
-            result for result in ranked_results
-            if result.adjusted_score >= current_threshold
-        ]
-        
-        return filtered_results
+        return ranked_results
     
     def get_search_analytics(self, search_results: Dict[str, Any]) -> Dict[str, Any]:
         """検索分析情報を取得"""
@@ -225,36 +286,28 @@ class AdvancedSearchService:
                 "query_effectiveness": {}
             }
         
-        # スコア統計
-        scores = [match.adjusted_score for match in matches]
-        average_score = sum(scores) / len(scores)
-        
-        # スコア分布
-        score_distribution = {
-            "0.8以上": len([s for s in scores if s >= 0.8]),
-            "0.6-0.8": len([s for s in scores if 0.6 <= s < 0.8]),
-            "0.4-0.6": len([s for s in scores if 0.4 <= s < 0.6]),
-            "0.4未満": len([s for s in scores if s < 0.4])
-        }
-        
-        # クエリ効果分析
-        query_effectiveness = {}
+        # スコア統計・スコア分布・クエリ効果を1回の走査で集計
+        total_score = 0.0
+        score_distribution = {"0.8以上": 0, "0.6-0.8": 0, "0.4-0.6": 0, "0.4未満": 0}
+        variation_scores = defaultdict(list)
         for match in matches:
-            variation = getattr(match, 'query_variation', 'unknown')
-            if variation not in query_effectiveness:
-                query_effectiveness[variation] = {
-                    "count": 0,
-                    "average_score": 0,
-                    "scores": []
-                }
-            query_effectiveness[variation]["count"] += 1
-            query_effectiveness[variation]["scores"].append(match.adjusted_score)
+            score = match.adjusted_score
+            total_score += score
+            if score >= 0.8:
+                score_distribution["0.8以上"] += 1
+            elif score >= 0.6:
+                score_distribution["0.6-0.8"] += 1
+            elif score >= 0.4:
+                score_distribution["0.4-0.6"] += 1
+            else:
+                score_distribution["0.4未満"] += 1
+            variation_scores[getattr(match, 'query_variation', 'unknown')].append(score)
         
-        # 平均スコアを計算
-        for variation in query_effectiveness:
-            scores = query_effectiveness[variation]["scores"]
-            query_effectiveness[variation]["average_score"] = sum(scores) / len(scores)
-            del query_effectiveness[variation]["scores"]  # 不要なデータを削除
+        average_score = total_score / len(matches)
+        query_effectiveness = {
+            variation: {"count": len(scores), "average_score": sum(scores) / len(scores)}
+            for variation, scores in variation_scores.items()
+        }
         
         return {
             "total_results": len(matches),
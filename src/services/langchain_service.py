@@ -5,8 +5,12 @@ from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.schema import HumanMessage, AIMessage, SystemMessage
 import os
+import heapq
+from collections import OrderedDict
+import functools
 import tiktoken
-from openai import OpenAI
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from ..config.settings import (
     PINECONE_API_KEY,
     PINECONE_INDEX_NAME,
@@ -14,16 +18,96 @@ from ..config.settings import (
     DEFAULT_TOP_K,
     SIMILARITY_THRESHOLD,
     DEFAULT_SYSTEM_PROMPT,
-    DEFAULT_RESPONSE_TEMPLATE
+    DEFAULT_RESPONSE_TEMPLATE,
+    DEBUG_MODE,
+    SEMANTIC_CACHE_SIZE,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_TTL,
+    EMBEDDING_CACHE_SIZE,
+    CHAIN_CACHE_SIZE
 )
 import streamlit as st
 from .advanced_search_service import AdvancedSearchService
+from .openai_client import get_openai_client
+from .pinecone_service import get_pinecone_service
+from .semantic_cache import SemanticCache
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding():
+    """トークンカウント用のエンコーダーを取得（プロセス内の全インスタンスで共有）"""
+    return tiktoken.get_encoding("cl100k_base")
+
+@functools.lru_cache(maxsize=64)
+def _count_static_tokens(text: str) -> int:
+    """システムプロンプトや物件情報など、繰り返し使われるテキストのトークン数をカウント"""
+    return len(_get_encoding().encode_ordinary(text))
+
+def _build_search_detail(score: float, preview: str, metadata: Dict[str, Any], **extra) -> Dict[str, Any]:
+    """検索結果1件分の詳細情報を作成（通常の検索・高度な検索で共通）"""
+    detail = {
+        "スコア": round(score, 4),
+        "テキスト": preview,
+        "ファイル名": metadata.get("source", "不明"),
+        "ページ番号": metadata.get("page", "不明"),
+        "セクション": metadata.get("section", "不明"),
+        "質問文例": metadata.get("question_examples", []),
+        **extra
+    }
+    # メタデータ全体（本文を含む）はデバッグ時のみ保持
+    if DEBUG_MODE:
+        detail["メタデータ"] = metadata
+    return detail
+
+def _build_prompt(system_prompt: str, with_property_info: bool) -> ChatPromptTemplate:
+    """プロンプトテンプレートを作成（システムプロンプト内の{context}なども変数として扱う）"""
+    messages = [
+        ("system", system_prompt),
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("system", "参照文脈:\n{context}")
+    ]
+    
+    # 物件情報がある場合は追加
+    if with_property_info:
+        messages.append(("system", "物件情報:\n{property_info}"))
+    
+    # ユーザー入力の追加
+    messages.append(("human", "{input}"))
+    
+    return ChatPromptTemplate.from_messages(messages)
+
+@functools.lru_cache(maxsize=None)
+def _get_embeddings() -> OpenAIEmbeddings:
+    """埋め込みモデルを取得（プロセス内の全インスタンスで共有）"""
+    return OpenAIEmbeddings(
+        api_key=OPENAI_API_KEY,
+        model="text-embedding-3-large",
+        dimensions=3072
+    )
+
+@functools.lru_cache(maxsize=EMBEDDING_CACHE_SIZE)
+def _embed_query_cached(query: str) -> np.ndarray:
+    """クエリの埋め込みベクトルを取得（同じクエリは全セッションで再利用。メモリ節約のためfloat32で保持）"""
+    return np.asarray(_get_embeddings().embed_query(query), dtype=np.float32)
+
+def _embed_query(query: str) -> List[float]:
+    """クエリの埋め込みベクトルを取得（前後の空白は除いてキャッシュを引く）"""
+    return _embed_query_cached(query.strip()).tolist()
+
+@functools.lru_cache(maxsize=None)
+def _get_vectorstore() -> PineconeVectorStore:
+    """Pineconeベクトルストアを取得（プロセス内の全インスタンスで共有）"""
+    # PineconeのAPIキーを環境変数に設定
+    os.environ["PINECONE_API_KEY"] = PINECONE_API_KEY
+    return PineconeVectorStore.from_existing_index(
+        index_name=PINECONE_INDEX_NAME,
+        embedding=_get_embeddings()
+    )
 
 class LangChainService:
     def __init__(self, callback_manager=None):
         """LangChainサービスの初期化"""
         # OpenAIクライアントの初期化
-        self.openai_client = OpenAI(api_key=OPENAI_API_KEY)
+        self.openai_client = get_openai_client()
         
         # チャットモデルの初期化
         self.llm = ChatOpenAI(
@@ -34,38 +118,37 @@ class LangChainService:
         )
         
         # 埋め込みモデルの初期化
-        self.embeddings = OpenAIEmbeddings(
-            api_key=OPENAI_API_KEY,
-            model="text-embedding-3-large",
-            dimensions=3072
-        )
+        self.embeddings = _get_embeddings()
         
         # トークンカウンターの初期化
-        self.encoding = tiktoken.encoding_for_model("gpt-4")
-        
-        # PineconeのAPIキーを環境変数に設定
-        os.environ["PINECONE_API_KEY"] = PINECONE_API_KEY
-        
-        # Pineconeベクトルストアの初期化
-        self.vectorstore = PineconeVectorStore.from_existing_index(
-            index_name=PINECONE_INDEX_NAME,
-            embedding=self.embeddings
-        )
+        self.encoding = _get_encoding()
         
         # チャット履歴の初期化
         self.message_history = ChatMessageHistory()
         
+        # 履歴メッセージのトークン数（内容ごとに一度だけエンコード）
+        self._message_tokens = {}
+        
         # デフォルトのプロンプトテンプレート
         self.system_prompt = DEFAULT_SYSTEM_PROMPT
         self.response_template = DEFAULT_RESPONSE_TEMPLATE
         
         # 高度な検索サービスの初期化
-        from .pinecone_service import PineconeService
-        pinecone_service = PineconeService()
-        self.advanced_search = AdvancedSearchService(pinecone_service)
+        self.advanced_search = AdvancedSearchService(get_pinecone_service())
         
         # 検索モードの設定（デフォルトは高度な検索）
         self.use_advanced_search = True
+        
+        # システムプロンプトごとの構築済みチェーン（LRU）
+        self._chains = OrderedDict()
+        
+        # 類似クエリの検索結果キャッシュ
+        self.context_cache = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL)
+
+    @functools.cached_property
+    def vectorstore(self) -> PineconeVectorStore:
+        """Pineconeベクトルストア（通常検索で初めて使うときに初期化）"""
+        return _get_vectorstore()
 
     def check_api_usage(self):
         """OpenAI APIの使用状況を確認"""
@@ -108,17 +191,48 @@ class LangChainService:
                 print("\n⚠️ Warning: Unable to check API usage. Please verify your API key and permissions.")
 
     def count_tokens(self, text: str) -> int:
-        """テキストのトークン数をカウント"""
-        return len(self.encoding.encode(text))
+        """テキストのトークン数をカウント（特殊トークンの検査が不要なためencode_ordinaryを使用）"""
+        return len(self.encoding.encode_ordinary(text))
+
+    def count_tokens_batch(self, texts: List[str]) -> List[int]:
+        """複数テキストのトークン数をまとめてカウント"""
+        return [len(tokens) for tokens in self.encoding.encode_ordinary_batch(texts)]
+
+    def _count_message_tokens(self, msg) -> int:
+        """履歴メッセージのトークン数をカウント（計算済みの内容は再エンコードしない）"""
+        tokens = self._message_tokens.get(msg.content)
+        if tokens is None:
+            tokens = self._message_tokens[msg.content] = self.count_tokens(msg.content)
+        return tokens
 
     def get_relevant_context(self, query: str, top_k: int = DEFAULT_TOP_K) -> Tuple[str, List[Dict[str, Any]], int]:
         """クエリに関連する文脈を取得（高度な検索を使用）"""
         try:
+            # 類似したクエリの検索結果がキャッシュにあれば再利用
+            # （検索モード・設定が同じで、その後ドキュメントがアップロードされていない場合のみ）
+            query_vector = _embed_query(query)
+            similarity_threshold = st.session_state.get("similarity_threshold", SIMILARITY_THRESHOLD)
+            cache_key = (
+                self.use_advanced_search,
+                top_k,
+                similarity_threshold,
+                self.advanced_search.pinecone_service.data_version
+            )
+            cached_context = self.context_cache.get(query_vector, cache_key)
+            if cached_context is not None:
+                print("類似したクエリの検索結果を再利用します")
+                return cached_context
+            
             # 高度な検索を使用するかどうかを確認
             if self.use_advanced_search:
-                return self._get_context_with_advanced_search(query, top_k)
+                context = self._get_context_with_advanced_search(query, top_k, query_vector)
             else:
-                return self._get_context_with_basic_search(query, top_k)
+                context = self._get_context_with_basic_search(query, top_k, query_vector)
+            
+            # 関連情報が見つかった場合のみキャッシュ
+            if context[0]:
+                self.context_cache.add(query_vector, context, cache_key)
+            return context
                 
         except Exception as e:
             error_message = str(e)
@@ -140,12 +254,12 @@ class LangChainService:
                     "エラータイプ": "Unknown Error"
                 }], 0
 
-    def _get_context_with_advanced_search(self, query: str, top_k: int) -> Tuple[str, List[Dict[str, Any]], int]:
+    def _get_context_with_advanced_search(self, query: str, top_k: int, query_vector: List[float] = None) -> Tuple[str, List[Dict[str, Any]], int]:
         """高度な検索を使用してコンテキストを取得"""
         print(f"\n=== 高度な検索を使用 ===")
         
         # マルチステップ検索を実行
-        search_results = self.advanced_search.multi_step_search(query)
+        search_results = self.advanced_search.multi_step_search(query, query_vector=query_vector)
         
         # 検索分析情報を取得
         analytics = self.advanced_search.get_search_analytics(search_results)
@@ -158,24 +272,20 @@ class LangChainService:
             return "", [], 0
         
         # コンテキストテキストを作成
-        context_text = "\n".join([match.metadata.get("text", "") for match in matches])
+        context_text = "\n".join(match.metadata.get("text", "") for match in matches)
         
         # 検索詳細情報を作成
-        search_details = []
-        for match in matches:
-            detail = {
-                "スコア": round(getattr(match, 'adjusted_score', match.score), 4),
-                "元のスコア": round(match.score, 4),
-                "テキスト": match.metadata.get("text", "")[:100] + "...",
-                "メタデータ": match.metadata,
-                "ファイル名": match.metadata.get("source", "不明"),
-                "ページ番号": match.metadata.get("page", "不明"),
-                "セクション": match.metadata.get("section", "不明"),
-                "クエリバリエーション": getattr(match, 'query_variation', 'unknown'),
-                "クエリ順序": getattr(match, 'query_index', 0),
-                "質問文例": match.metadata.get("question_examples", [])
-            }
-            search_details.append(detail)
+        search_details = [
+            _build_search_detail(
+                getattr(match, 'adjusted_score', match.score),
+                match.metadata.get("text", "")[:100] + "...",
+                match.metadata,
+                元のスコア=round(match.score, 4),
+                クエリバリエーション=getattr(match, 'query_variation', 'unknown'),
+                クエリ順序=getattr(match, 'query_index', 0)
+            )
+            for match in matches
+        ]
         
         # コンテキストのトークン数をカウント
         context_tokens = self.count_tokens(context_text)
@@ -183,122 +293,91 @@ class LangChainService:
         
         return context_text, search_details, context_tokens
 
-    def _get_context_with_basic_search(self, query: str, top_k: int) -> Tuple[str, List[Dict[str, Any]], int]:
+    def _get_context_with_basic_search(self, query: str, top_k: int, query_vector: List[float]) -> Tuple[str, List[Dict[str, Any]], int]:
         """基本的な検索を使用してコンテキストを取得（従来の方法）"""
         print(f"\n=== 基本的な検索を使用 ===")
         
         # 設定画面で変更されたしきい値を取得（デフォルトはSIMILARITY_THRESHOLD）
         similarity_threshold = st.session_state.get("similarity_threshold", SIMILARITY_THRESHOLD)
         
-        # クエリのトークン数をカウント
-        query_tokens = self.count_tokens(query)
-        print(f"クエリのトークン数: {query_tokens}")
         print(f"使用する類似度しきい値: {similarity_threshold}")
         
-        # クエリのベクトル化
-        query_vector = self.embeddings.embed_query(query)
-        
-        # 検索を実行
-        docs = self.vectorstore.similarity_search_with_score(query, k=top_k)
-        
-        # メタデータを簡略化して保持
-        simplified_docs = []
-        for doc in docs:
-            # メタデータを簡略化
-            simplified_metadata = {}
-            for key, value in doc[0].metadata.items():
-                if isinstance(value, str):
-                    # メタデータの値を短くする（最大100文字）
-                    simplified_metadata[key] = value[:100] + "..." if len(value) > 100 else value
+        # 検索を実行（ベクトル化済みのクエリを使い、再度の埋め込み生成を避ける）
+        docs = self.vectorstore.similarity_search_by_vector_with_score(query_vector, k=top_k)
+        
+        # しきい値以上の候補のみを簡略化し、文脈と詳細情報を1回の走査で作成
+        contents = []
+        search_details = []
+        for doc, score in docs:
+            # スコアでフィルタリング（しきい値未満は除外）
+            if score < similarity_threshold:
+                continue
+            
+            # メタデータを簡略化（文字列の値のみ、最大100文字）
+            simplified_metadata = {
+                key: value[:100] + "..." if len(value) > 100 else value
+                for key, value in doc.metadata.items()
+                if isinstance(value, str)
+            }
             
-            # テキストを短くする（最大500文字）
-            content = doc[0].page_content
+            # テキストを短くする（最大500文字、表示用の先頭100文字もここで1回だけ切り出す）
+            content = doc.page_content
+            preview = content[:100] + "..."
             if len(content) > 500:
                 content = content[:500] + "..."
+            contents.append(content)
             
-            # 簡略化したドキュメントを作成
-            simplified_doc = {
-                "content": content,
-                "metadata": simplified_metadata,
-                "score": doc[1]
-            }
-            simplified_docs.append(simplified_doc)
-        
-        # スコアでフィルタリング（しきい値未満は除外）
-        filtered_docs = [
-            doc for doc in simplified_docs
-            if doc["score"] >= similarity_threshold
-        ]
+            search_details.append(_build_search_detail(score, preview, simplified_metadata))
         
-        print(f"取得した候補数: {len(simplified_docs)}")
-        print(f"しきい値({similarity_threshold})以上の候補数: {len(filtered_docs)}")
-        if filtered_docs:
-            print("採用された候補のスコア:")
-            for doc in filtered_docs:
-                print(f"スコア: {doc['score']:.3f}, テキスト: {doc['content'][:100]}...")
-        else:
+        print(f"取得した候補数: {len(docs)}")
+        print(f"しきい値({similarity_threshold})以上の候補数: {len(contents)}")
+        if not contents:
             print("しきい値以上の候補が見つかりませんでした。")
+        elif DEBUG_MODE:
+            # 候補ごとの本文の表示はデバッグ時のみ
+            print("採用された候補のスコア:")
+            print("\n".join(f"スコア: {detail['スコア']:.3f}, テキスト: {detail['テキスト']}" for detail in search_details))
         
-        # コンテキストテキストを作成（メタデータを含めない）
-        if filtered_docs:
-            context_text = "\n".join([doc["content"] for doc in filtered_docs])
-        else:
-            # 関連情報が見つからない場合は空文字列を返す
-            context_text = ""
+        # コンテキストテキストを作成（メタデータを含めない、関連情報がない場合は空文字列）
+        context_text = "\n".join(contents)
         
         # コンテキストのトークン数をカウント
         context_tokens = self.count_tokens(context_text)
         print(f"コンテキストのトークン数: {context_tokens}")
         
-        search_details = []
-        for doc in filtered_docs:
-            detail = {
-                "スコア": round(doc["score"], 4),
-                "テキスト": doc["content"][:100] + "...",
-                "メタデータ": doc["metadata"],
-                "ファイル名": doc["metadata"].get("source", "不明"),
-                "ページ番号": doc["metadata"].get("page", "不明"),
-                "セクション": doc["metadata"].get("section", "不明"),
-                "質問文例": doc["metadata"].get("question_examples", [])
-            }
-            search_details.append(detail)
-        
         return context_text, search_details, context_tokens
 
     def set_search_mode(self, use_advanced: bool = True):
         """検索モードを設定"""
+        # 画面の再実行ごとに呼ばれるため、変更があった場合のみ出力
+        if self.use_advanced_search == use_advanced:
+            return
         self.use_advanced_search = use_advanced
         print(f"検索モードを {'高度な検索' if use_advanced else '基本的な検索'} に設定しました")
 
-    def get_response(self, query: str, system_prompt: str = None, response_template: str = None, property_info: str = None, chat_history: list = None) -> Tuple[str, Dict[str, Any]]:
-        """クエリに対する応答を生成"""
+    def get_response(self, query: str, system_prompt: str = None, response_template: str = None, property_info: str = None, chat_history: list = None, on_token=None) -> Tuple[str, Dict[str, Any]]:
+        """クエリに対する応答を生成（on_tokenを指定すると生成中の応答を逐次渡す）"""
         try:
             # プロンプトの設定
             system_prompt = system_prompt or self.system_prompt
             response_template = response_template or self.response_template
             
-            # メッセージリストの作成
-            messages = [
-                ("system", system_prompt),
-                MessagesPlaceholder(variable_name="chat_history"),
-                ("system", "参照文脈:\n{context}")
-            ]
-            
-            # 物件情報がある場合は追加
-            if property_info:
-                messages.append(("system", "物件情報:\n{property_info}"))
-            
-            # ユーザー入力の追加
-            messages.append(("human", "{input}"))
-            
-            # プロンプトテンプレートの設定
-            prompt = ChatPromptTemplate.from_messages(messages)
-            
-            # チェーンの初期化
-            chain = prompt | self.llm
+            # チェーンの取得（同じシステムプロンプト・物件情報の有無であれば構築済みのものを使う。LRUで件数を制限）
+            chain_key = (system_prompt, bool(property_info))
+            chain = self._chains.get(chain_key)
+            if chain is None:
+                chain = self._chains[chain_key] = _build_prompt(*chain_key) | self.llm
+                if len(self._chains) > CHAIN_CACHE_SIZE:
+                    self._chains.popitem(last=False)
+            else:
+                self._chains.move_to_end(chain_key)
             
-            # 関連する文脈を取得
-            context, search_details, context_tokens = self.get_relevant_context(query)
+            # 会話履歴の準備（トークン数の計算を含む）を別スレッドで進めながら、関連する文脈を取得
+            # （文脈の取得は設定画面の値を参照するため、Streamlitのスレッドで実行する）
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                history_future = executor.submit(self._prepare_chat_history, chat_history)
+                context, search_details, context_tokens = self.get_relevant_context(query)
+                history_tokens = history_future.result()
             
             # 参照文脈が空の場合の処理
             if not context.strip():
@@ -306,56 +385,54 @@ class LangChainService:
                 context = "【重要】参照文脈に情報がありません。この場合、絶対に推測や一般的な知識で回答せず、情報がないことを明確に伝えてください。"
                 print("⚠️ 参照文脈が空のため、情報がないことを明確に伝えるよう指示します")
             
-            # チャット履歴を設定
-            if chat_history:
-                self.message_history.messages = []
-                for role, content in chat_history:
-                    if role == "human":
-                        self.message_history.add_user_message(content)
-                    elif role == "ai":
-                        self.message_history.add_ai_message(content)
-            
-            # 会話履歴を最適化
-            self.optimize_chat_history()
-            
-            # プロンプトのトークン数をカウント
-            prompt_tokens = self.count_tokens(system_prompt)
+            # プロンプト・物件情報のトークン数は同じテキストであれば再計算しない
+            prompt_tokens = _count_static_tokens(system_prompt)
+            property_info_tokens = _count_static_tokens(property_info) if property_info else 0
+            query_tokens = self.count_tokens(query)
             print(f"システムプロンプトのトークン数: {prompt_tokens}")
-            
-            # チャット履歴のトークン数をカウント
-            history_tokens = sum(self.count_tokens(msg.content) for msg in self.message_history.messages)
+            print(f"クエリのトークン数: {query_tokens}")
             print(f"チャット履歴のトークン数: {history_tokens}")
             
-            # デバッグ出力：送信されるすべてのテキストを表示
-            print("\n=== 送信されるテキスト ===")
-            print("\n--- システムプロンプト ---")
-            print(system_prompt)
-            print("\n--- チャット履歴 ---")
-            for msg in self.message_history.messages:
-                print(f"\n[{msg.type}]: {msg.content}")
-            print("\n--- 参照文脈 ---")
-            print(context)
-            if property_info:
-                print("\n--- 物件情報 ---")
-                print(property_info)
-            print("\n--- ユーザー入力 ---")
-            print(query)
+            # デバッグ出力：送信されるすべてのテキストを表示（数KB以上になるためデバッグ時のみ）
+            # （標準出力への書き込みは1回にまとめる）
+            if DEBUG_MODE:
+                sections = [
+                    "\n=== 送信されるテキスト ===",
+                    "\n--- システムプロンプト ---", system_prompt,
+                    "\n--- チャット履歴 ---",
+                    *(f"\n[{msg.type}]: {msg.content}" for msg in self.message_history.messages),
+                    "\n--- 参照文脈 ---", context
+                ]
+                if property_info:
+                    sections += ["\n--- 物件情報 ---", property_info]
+                sections += ["\n--- ユーザー入力 ---", query]
+                print("\n".join(sections))
             
             # 応答を生成
-            response = chain.invoke({
+            chain_input = {
                 "chat_history": self.message_history.messages,
                 "context": context,
                 "property_info": property_info or "物件情報はありません。",
                 "input": query
-            })
+            }
+            if on_token:
+                # ストリーミングで生成し、受信した部分から順に通知
+                response_parts = []
+                for chunk in chain.stream(chain_input):
+                    response_parts.append(chunk.content)
+                    on_token(chunk.content)
+                response_text = "".join(response_parts)
+            else:
+                response_text = chain.invoke(chain_input).content
             
             # 応答のトークン数をカウント
-            response_tokens = self.count_tokens(response.content)
+            response_tokens = self.count_tokens(response_text)
             print(f"応答のトークン数: {response_tokens}")
             
-            # メッセージを履歴に追加
+            # メッセージを履歴に追加（応答のトークン数は次回以降の履歴計算で再利用）
             self.message_history.add_user_message(query)
-            self.message_history.add_ai_message(response.content)
+            self.message_history.add_ai_message(response_text)
+            self._message_tokens[response_text] = response_tokens
             
             # 詳細情報の作成
             details = {
@@ -365,9 +442,9 @@ class LangChainService:
                     "システムプロンプト": prompt_tokens,
                     "チャット履歴": history_tokens,
                     "参照文脈": context_tokens,
-                    "物件情報": self.count_tokens(property_info) if property_info else 0,
-                    "ユーザー入力": self.count_tokens(query),
-                    "合計": prompt_tokens + history_tokens + context_tokens + (self.count_tokens(property_info) if property_info else 0)
+                    "物件情報": property_info_tokens,
+                    "ユーザー入力": query_tokens,
+                    "合計": prompt_tokens + history_tokens + context_tokens + property_info_tokens
                 },
                 "送信テキスト": {
                     "システムプロンプト": system_prompt,
@@ -379,7 +456,7 @@ class LangChainService:
                 }
             }
             
-            return response.content, details
+            return response_text, details
             
         except Exception as e:
             error_message = str(e)
@@ -402,21 +479,47 @@ class LangChainService:
             
             return error_response, error_details
 
-    def optimize_chat_history(self, max_tokens: int = 10000) -> None:
-        """会話履歴を最適化し、重要なメッセージのみを保持"""
+    def _prepare_chat_history(self, chat_history: list = None) -> int:
+        """チャット履歴を設定・最適化し、履歴のトークン数を返す"""
+        # チャット履歴を設定（メッセージを1件ずつ追加せず、リストをまとめて差し替える）
+        if chat_history:
+            message_types = {"human": HumanMessage, "ai": AIMessage}
+            self.message_history.messages = [
+                message_types[role](content=content)
+                for role, content in chat_history
+                if role in message_types
+            ]
+            
+            # 履歴から外れたメッセージのトークン数は破棄し、未計算のメッセージはまとめてカウント
+            self._message_tokens = {
+                msg.content: self._message_tokens[msg.content]
+                for msg in self.message_history.messages
+                if msg.content in self._message_tokens
+            }
+            new_contents = list(dict.fromkeys(
+                msg.content for msg in self.message_history.messages
+                if msg.content not in self._message_tokens
+            ))
+            self._message_tokens.update(zip(new_contents, self.count_tokens_batch(new_contents)))
+        
+        # 会話履歴を最適化（最適化後の履歴のトークン数が返る）
+        return self.optimize_chat_history()
+
+    def optimize_chat_history(self, max_tokens: int = 10000) -> int:
+        """会話履歴を最適化し、重要なメッセージのみを保持（最適化後の履歴のトークン数を返す）"""
         if not self.message_history.messages:
-            return
+            return 0
 
         # システムプロンプトとコンテキスト用のトークン数を確保（約4000トークン）
         reserved_tokens = 4000
         available_tokens = max_tokens - reserved_tokens
 
         # 現在のトークン数を計算
-        current_tokens = sum(self.count_tokens(msg.content) for msg in self.message_history.messages)
+        current_tokens = sum(self._count_message_tokens(msg) for msg in self.message_history.messages)
         
         # トークン数が制限を超えていない場合は何もしない
         if current_tokens <= available_tokens:
-            return
+            return current_tokens
 
         # メッセージを重要度で分類
         important_messages = []
@@ -435,35 +538,40 @@ class LangChainService:
             other_messages = other_messages[:-1]
 
         # 重要メッセージのトークン数を計算
-        important_tokens = sum(self.count_tokens(msg.content) for msg in important_messages)
+        important_tokens = sum(self._count_message_tokens(msg) for msg in important_messages)
         
         # 残りのトークン数
         remaining_tokens = available_tokens - important_tokens
 
-        # 残りのトークン数に基づいて、他のメッセージを追加
-        # メッセージを長さでソート（短いものから）
-        other_messages.sort(key=lambda x: self.count_tokens(x.content))
-        
-        for msg in other_messages:
-            msg_tokens = self.count_tokens(msg.content)
-            if msg_tokens <= remaining_tokens:
-                important_messages.insert(0, msg)  # 先頭に追加
-                remaining_tokens -= msg_tokens
-            else:
-                break
+        # 残りのトークン数に基づいて、他のメッセージを短いものから追加
+        # （全体をソートせず、ヒープから収まる分だけ取り出す。同じ長さは元の順序を優先）
+        candidates = [(self._count_message_tokens(msg), i, msg) for i, msg in enumerate(other_messages)]
+        heapq.heapify(candidates)
+        
+        selected_messages = []
+        while candidates and candidates[0][0] <= remaining_tokens:
+            msg_tokens, _, msg = heapq.heappop(candidates)
+            selected_messages.append(msg)
+            remaining_tokens -= msg_tokens
+        
+        # 後から選ばれたものほど先頭に来るように追加
+        important_messages = selected_messages[::-1] + important_messages
 
         # 最適化されたメッセージで履歴を更新
         self.message_history.messages = important_messages
 
-        # デバッグ情報の出力
-        final_tokens = sum(self.count_tokens(msg.content) for msg in self.message_history.messages)
+        # デバッグ情報の出力（保持したメッセージのトークン数は確保済みの分から求める）
+        final_tokens = available_tokens - remaining_tokens
         print(f"\n=== Chat History Optimization ===")
         print(f"Original tokens: {current_tokens}")
         print(f"Final tokens: {final_tokens}")
         print(f"Messages kept: {len(self.message_history.messages)}")
         print(f"Available tokens: {available_tokens}")
         print(f"Remaining tokens: {remaining_tokens}")
+        
+        return final_tokens
 
     def clear_memory(self):
         """会話メモリをクリア"""
-        self.message_history.clear() 
\ No newline at end of file
+        self.message_history.clear()
+        self._message_tokens = {} 
\ No newline at end of file
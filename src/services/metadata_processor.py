@@ -5,7 +5,7 @@ from langchain.prompts import ChatPromptTemplate
 from langchain.output_parsers import PydanticOutputParser
 from pydantic import BaseModel, Field
 from src.config.settings import OPENAI_API_KEY
-import json
+import orjson
 
 @dataclass
 class MetadataField:
@@ -89,9 +89,9 @@ class MetadataProcessor:
                 raise ValueError("No JSON object found in response")
             
             json_text = response_text[first_json_start:first_json_end]
-            metadata = json.loads(json_text)
+            metadata = orjson.loads(json_text)
             return metadata
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             raise ValueError(f"Failed to parse metadata: {str(e)}\nResponse text: {response_text}")
 
     def validate_metadata(self, question_type: str, metadata: Dict[str, Any]) -> bool:
@@ -0,0 +1,12 @@
+"""
+OpenAIクライアントを共有するモジュール
+"""
+
+import functools
+from openai import OpenAI
+from ..config.settings import OPENAI_API_KEY
+
+@functools.lru_cache(maxsize=None)
+def get_openai_client() -> OpenAI:
+    """プロセス全体で共有するOpenAIクライアントを取得（HTTP接続プールを各サービスで再利用）"""
+    return OpenAI(api_key=OPENAI_API_KEY)
@@ -1,7 +1,7 @@
 from typing import List, Dict, Any
 from pinecone import Pinecone
-from openai import OpenAI
 import time
+import functools
 from ..config.settings import (
     PINECONE_API_KEY,
     PINECONE_INDEX_NAME,
@@ -9,9 +9,11 @@ from ..config.settings import (
     EMBEDDING_MODEL,
     BATCH_SIZE,
     DEFAULT_TOP_K,
-    SIMILARITY_THRESHOLD
+    SIMILARITY_THRESHOLD,
+    DEBUG_MODE
 )
-import json
+import orjson
+from .openai_client import get_openai_client
 import streamlit as st
 
 class PineconeService:
@@ -21,7 +23,7 @@ class PineconeService:
             # OpenAIクライアントの初期化
             if not OPENAI_API_KEY:
                 raise ValueError("OpenAI APIキーが設定されていません")
-            self.openai_client = OpenAI(api_key=OPENAI_API_KEY)
+            self.openai_client = get_openai_client()
             
             # Pineconeの初期化
             if not PINECONE_API_KEY:
@@ -31,6 +33,9 @@ class PineconeService:
             
             self.pc = Pinecone(api_key=PINECONE_API_KEY)
             
+            # インデックスの内容が変わるたびに増える番号（検索結果・応答のキャッシュキーに使用）
+            self.data_version = 0
+            
             # インデックスの存在確認と初期化
             self._initialize_index()
             
@@ -110,6 +115,29 @@ class PineconeService:
                 else:
                     raise Exception(f"埋め込みベクトルの生成に失敗しました（最大試行回数到達）: {str(e)}")
 
+    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """複数テキストの埋め込みベクトルを1回のリクエストで取得"""
+        max_retries = 3
+        retry_delay = 1  # seconds
+        
+        for attempt in range(max_retries):
+            try:
+                response = self.openai_client.embeddings.create(
+                    model="text-embedding-3-large",
+                    input=texts,
+                    encoding_format="float"
+                )
+                # 入力順に並べて返す
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            except Exception as e:
+                if attempt < max_retries - 1:
+                    print(f"埋め込みベクトルの一括生成に失敗しました（試行 {attempt + 1}/{max_retries}）: {str(e)}")
+                    print(f"{retry_delay}秒後に再試行します...")
+                    time.sleep(retry_delay)
+                    retry_delay *= 2
+                else:
+                    raise Exception(f"埋め込みベクトルの一括生成に失敗しました（最大試行回数到達）: {str(e)}")
+
     def upload_chunks(self, chunks: List[Dict[str, Any]], namespace: str = None, batch_size: int = BATCH_SIZE) -> None:
         """チャンクをPineconeにアップロード"""
         if not chunks:
@@ -126,14 +154,23 @@ class PineconeService:
                 batch_num = i // batch_size + 1
                 print(f"\nバッチ {batch_num} を処理中... ({len(batch)}件)")
                 
-                # バッチ内の各チャンクの埋め込みベクトルを取得
+                # バッチ内の全チャンクの埋め込みベクトルを1回のリクエストで取得
                 vectors = []
                 retry_chunks = []  # 再試行が必要なチャンク
                 
-                for j, chunk in enumerate(batch, 1):
+                try:
+                    print(f"  {len(batch)}件の埋め込みベクトルを一括生成中...")
+                    batch_vectors = self.get_embeddings([chunk["text"] for chunk in batch])
+                except Exception as e:
+                    # 一括生成に失敗した場合はチャンクごとに生成する
+                    print(f"  一括生成に失敗したため、チャンクごとに生成します: {str(e)}")
+                    batch_vectors = [None] * len(batch)
+                
+                for j, (chunk, vector) in enumerate(zip(batch, batch_vectors), 1):
                     try:
-                        print(f"  チャンク {j}/{len(batch)} の埋め込みベクトルを生成中...")
-                        vector = self.get_embedding(chunk["text"])
+                        if vector is None:
+                            print(f"  チャンク {j}/{len(batch)} の埋め込みベクトルを生成中...")
+                            vector = self.get_embedding(chunk["text"])
                         
                         # メタデータの設定（CSVファイルのメタデータを含める）
                         metadata = {
@@ -158,7 +195,7 @@ class PineconeService:
                         }
                         
                         # デバッグ情報の表示
-                        print(f"  メタデータ: {json.dumps(metadata, ensure_ascii=False)}")
+                        print(f"  メタデータ: {orjson.dumps(metadata).decode()}")
                         
                         vectors.append({
                             "id": chunk["id"],
@@ -179,6 +216,7 @@ class PineconeService:
                             # バッチをアップロード（namespaceを指定）
                             print(f"  {len(vectors)}件のベクトルをアップロード中...")
                             self.index.upsert(vectors=vectors, namespace=namespace)
+                            self.data_version += 1
                             print(f"  バッチ {batch_num} のアップロードが完了しました")
                             break
                         except Exception as e:
@@ -200,20 +238,24 @@ class PineconeService:
         except Exception as e:
             raise Exception(f"チャンクのアップロードに失敗しました: {str(e)}")
 
-    def query(self, query_text: str, namespace: str = None, top_k: int = DEFAULT_TOP_K, similarity_threshold: float = SIMILARITY_THRESHOLD) -> Dict[str, Any]:
+    def query(self, query_text: str, namespace: str = None, top_k: int = DEFAULT_TOP_K, similarity_threshold: float = None) -> Dict[str, Any]:
         """クエリに基づいて類似チャンクを検索"""
+        # クエリのベクトル化
+        query_vector = self.get_embedding(query_text)
+        print(f"検索クエリ: {query_text}")
+        return self.query_by_vector(query_vector, namespace, top_k, similarity_threshold)
+
+    def query_by_vector(self, query_vector: List[float], namespace: str = None, top_k: int = DEFAULT_TOP_K, similarity_threshold: float = None) -> Dict[str, Any]:
+        """埋め込みベクトルに基づいて類似チャンクを検索（ワーカースレッドから呼ぶ場合はしきい値を必ず指定）"""
         max_retries = 3
         retry_delay = 1
         
-        # 設定画面で変更された値を取得（引数で渡された値が優先）
-        if similarity_threshold == SIMILARITY_THRESHOLD:  # デフォルト値が使用されている場合
+        # しきい値が指定されていない場合のみ設定画面の値を取得（セッション状態はStreamlitのスレッドでのみ参照可能）
+        if similarity_threshold is None:
             similarity_threshold = st.session_state.get("similarity_threshold", SIMILARITY_THRESHOLD)
         
         for attempt in range(max_retries):
             try:
-                # クエリのベクトル化
-                query_vector = self.get_embedding(query_text)
-                print(f"検索クエリ: {query_text}")
                 print(f"類似度しきい値: {similarity_threshold}")
                 print(f"取得する候補数: {top_k}")
                 
@@ -226,10 +268,9 @@ class PineconeService:
                 )
                 
                 print(f"取得した候補数: {len(results.matches)}")
-                if results.matches:
+                if DEBUG_MODE and results.matches:
                     print("候補のスコア:")
-                    for match in results.matches:
-                        print(f"スコア: {match.score:.3f}")
+                    print("\n".join(f"スコア: {match.score:.3f}" for match in results.matches))
                 
                 # 類似度でフィルタリング（しきい値未満は除外）
                 filtered_matches = [
@@ -238,12 +279,15 @@ class PineconeService:
                 ]
                 
                 print(f"しきい値({similarity_threshold})以上の候補数: {len(filtered_matches)}")
-                if filtered_matches:
-                    print("採用された候補のスコア:")
-                    for match in filtered_matches:
-                        print(f"スコア: {match.score:.3f}, テキスト: {match.metadata['text'][:100]}...")
-                else:
+                if not filtered_matches:
                     print("しきい値以上の候補が見つかりませんでした。")
+                elif DEBUG_MODE:
+                    # 候補ごとの本文の表示はデバッグ時のみ
+                    print("採用された候補のスコア:")
+                    print("\n".join(
+                        f"スコア: {match.score:.3f}, テキスト: {match.metadata['text'][:100]}..."
+                        for match in filtered_matches
+                    ))
                 
                 return {
                     "matches": filtered_matches,
@@ -289,6 +333,7 @@ class PineconeService:
         """インデックスをクリア"""
         try:
             self.index.delete(delete_all=True, namespace=namespace)
+            self.data_version += 1
             print(f"インデックスをクリアしました（namespace: {namespace if namespace else 'default'}）")
         except Exception as e:
             raise Exception(f"インデックスのクリアに失敗しました: {str(e)}")
@@ -418,4 +463,9 @@ class PineconeService:
             }
         except Exception as e:
             print(f"ベクトルの取得中にエラーが発生しました: {str(e)}")
-            return None 
\ No newline at end of file
+            return None 
+
+@functools.lru_cache(maxsize=None)
+def get_pinecone_service() -> PineconeService:
+    """プロセス全体で共有するPineconeサービスを取得（初期化に失敗した場合はキャッシュせず次回再試行）"""
+    return PineconeService()
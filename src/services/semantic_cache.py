@@ -0,0 +1,73 @@
+"""
+クエリの埋め込みベクトルの類似度で検索結果を再利用するキャッシュ
+"""
+
+import time
+from typing import Any, Hashable, List, Optional
+import numpy as np
+
+class SemanticCache:
+    def __init__(self, max_entries: int, threshold: float, ttl: float):
+        """セマンティックキャッシュの初期化"""
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+
+        # 正規化した埋め込みベクトルをint8に量子化した行列と、行ごとのスケール
+        # （行列は最初の追加時に次元数に合わせて確保。float32の1/4のメモリで済む）
+        self._vectors = None
+        self._scales = np.zeros(max_entries, dtype=np.float32)
+        self._keys: List[Optional[Hashable]] = [None] * max_entries
+        self._payloads: List[Any] = [None] * max_entries
+        self._created_at = np.zeros(max_entries, dtype=np.float64)
+        self._size = 0
+        self._next = 0  # 次に書き込む位置（上限に達したら最も古いものから上書き）
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        """コサイン類似度を内積で求められるようにL2正規化"""
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def get(self, vector: List[float], key: Hashable = None) -> Any:
+        """類似度がしきい値以上で同じキーのエントリがあれば、その値を返す"""
+        if not self._size:
+            return None
+
+        similarities = (self._vectors[:self._size] @ self._normalize(vector)) * self._scales[:self._size]
+
+        # キーが異なるもの・有効期限切れのものは対象外
+        expired = self._created_at[:self._size] < time.time() - self.ttl
+        for index in np.argsort(similarities)[::-1]:
+            if similarities[index] < self.threshold:
+                break
+            if not expired[index] and self._keys[index] == key:
+                return self._payloads[index]
+        return None
+
+    def add(self, vector: List[float], payload: Any, key: Hashable = None) -> None:
+        """エントリを追加"""
+        normalized = self._normalize(vector)
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_entries, normalized.shape[0]), dtype=np.int8)
+
+        # 最大の絶対値が127になるようにスケーリングして量子化
+        scale = float(np.abs(normalized).max()) / 127 or 1.0
+
+        index = self._next
+        self._vectors[index] = np.round(normalized / scale)
+        self._scales[index] = scale
+        self._keys[index] = key
+        self._payloads[index] = payload
+        self._created_at[index] = time.time()
+
+        self._next = (index + 1) % self.max_entries
+        self._size = min(self._size + 1, self.max_entries)
+
+    def clear(self) -> None:
+        """キャッシュをクリア"""
+        self._keys = [None] * self.max_entries
+        self._payloads = [None] * self.max_entries
+        self._size = 0
+        self._next = 0
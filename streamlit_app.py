@@ -8,7 +8,7 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from src.utils.text_processing import process_text_file
-from src.services.pinecone_service import PineconeService
+from src.services.pinecone_service import get_pinecone_service
 from src.components.file_upload import render_file_upload
 from src.components.chat import render_chat
 from src.components.settings import render_settings
@@ -37,7 +37,7 @@ if "response_template" not in st.session_state:
 
 # Pineconeサービスの初期化
 try:
-    pinecone_service = PineconeService()
+    pinecone_service = get_pinecone_service()
     # インデックスの状態を確認
     stats = pinecone_service.get_index_stats()
     if stats['total_vector_count'] == 0: